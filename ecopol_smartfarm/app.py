@@ -7,19 +7,24 @@ from typing import Dict, Any, Optional, Tuple, List
 
 import pandas as pd
 import plotly.express as px
-import requests
+import plotly.graph_objects as go
 import streamlit as st
 
-# Opcionales según conector
-try:
-    import paho.mqtt.client as mqtt
-except Exception:
-    mqtt = None
-
-try:
-    from pymodbus.client import ModbusTcpClient
-except Exception:
-    ModbusTcpClient = None
+from db import (
+    db_connect,
+    db_init,
+    seed_demo,
+    get_sites,
+    get_latest_metrics,
+    get_multi_history,
+    GAP_FILLS,
+    TREND_METRICS,
+    get_thresholds,
+    evaluate_alerts,
+)
+from derived import derived_names
+from connectors import fetch_http_readings, mqtt_help_text, modbus_read_example
+from edge_buffer import DRAIN_BUSY_TIMEOUT_S, BufferFull, EdgeBuffer
 
 
 # -----------------------------
@@ -27,330 +32,42 @@ except Exception:
 # -----------------------------
 st.set_page_config(page_title="Ecopol SmartFarm (MVP)", layout="wide")
 
-# -----------------------------
-# DB simple (SQLite)
-# -----------------------------
-DB_PATH = "data/demo.sqlite"
-
-
-def db_connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
-
-
-def db_init(conn: sqlite3.Connection) -> None:
-    conn.executescript(
-        """
-        CREATE TABLE IF NOT EXISTS clients(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          name TEXT NOT NULL,
-          phone TEXT,
-          email TEXT,
-          address TEXT,
-          notes TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS sites(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          client_id INTEGER NOT NULL,
-          name TEXT NOT NULL,
-          location TEXT,
-          type TEXT, -- 'Avícola' / 'Porcina' / 'Mixta'
-          FOREIGN KEY(client_id) REFERENCES clients(id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS equipment(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          site_id INTEGER NOT NULL,
-          name TEXT NOT NULL,
-          category TEXT, -- 'Climatización' 'Alimentación' 'Agua' 'Calefacción' 'Sensores'
-          model TEXT,
-          serial TEXT,
-          install_date TEXT,
-          status TEXT, -- 'Operativo' 'En observación' 'Fuera de servicio'
-          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS sensor_sources(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          site_id INTEGER NOT NULL,
-          name TEXT NOT NULL,
-          protocol TEXT NOT NULL, -- 'HTTP' 'MQTT' 'MODBUS' 'CSV' 'MANUAL'
-          config_json TEXT NOT NULL,
-          enabled INTEGER NOT NULL DEFAULT 1,
-          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS sensor_readings(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          site_id INTEGER NOT NULL,
-          source_id INTEGER,
-          ts TEXT NOT NULL,
-          metric TEXT NOT NULL, -- 'temp_c', 'hum_pct', 'co2_ppm', 'nh3_ppm', 'water_lpm', etc.
-          value REAL NOT NULL,
-          meta_json TEXT,
-          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE,
-          FOREIGN KEY(source_id) REFERENCES sensor_sources(id) ON DELETE SET NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS thresholds(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          site_id INTEGER NOT NULL,
-          metric TEXT NOT NULL,
-          min_value REAL,
-          max_value REAL,
-          warn_min REAL,
-          warn_max REAL,
-          enabled INTEGER NOT NULL DEFAULT 1,
-          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS maintenance(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          site_id INTEGER NOT NULL,
-          equipment_id INTEGER,
-          type TEXT NOT NULL, -- 'Preventivo' 'Correctivo'
-          status TEXT NOT NULL, -- 'Programado' 'En curso' 'Cerrado'
-          priority TEXT NOT NULL, -- 'Baja' 'Media' 'Alta'
-          scheduled_for TEXT,
-          performed_at TEXT,
-          description TEXT,
-          actions_taken TEXT,
-          parts_used TEXT,
-          next_due TEXT,
-          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE,
-          FOREIGN KEY(equipment_id) REFERENCES equipment(id) ON DELETE SET NULL
-        );
-        """
-    )
-    conn.commit()
-
-
-def seed_demo(conn: sqlite3.Connection) -> None:
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM clients")
-    if cur.fetchone()[0] > 0:
-        return
-
-    # Cliente + sitio + equipos
-    cur.execute("INSERT INTO clients(name, phone, email, address, notes) VALUES (?,?,?,?,?)",
-                ("Granja Los Robles", "+56 9 1234 5678", "contacto@cliente.cl", "Región del Maule", "Cliente demo"))
-    client_id = cur.lastrowid
-
-    cur.execute("INSERT INTO sites(client_id, name, location, type) VALUES (?,?,?,?)",
-                (client_id, "Sitio 1 - Galpones", "Maule, Chile", "Avícola"))
-    site_id = cur.lastrowid
-
-    equipments = [
-        ("Controlador Temp ITC10", "Climatización", "ITC10", "SN-ITC10-001", "2025-11-01", "Operativo"),
-        ("Sistema Transporte Espiral", "Alimentación", "Spiral-01", "SN-SP-009", "2025-10-15", "Operativo"),
-        ("Línea de Bebederos", "Agua", "WaterLine-X", "SN-WL-120", "2025-10-20", "En observación"),
-        ("Radiador Infrarrojo", "Calefacción", "IR-Heat", "SN-IR-777", "2025-10-18", "Operativo"),
-    ]
-    for name, cat, model, serial, d, status in equipments:
-        cur.execute("""
-            INSERT INTO equipment(site_id, name, category, model, serial, install_date, status)
-            VALUES (?,?,?,?,?,?,?)
-        """, (site_id, name, cat, model, serial, d, status))
-
-    # Umbrales demo
-    cur.execute("""
-        INSERT INTO thresholds(site_id, metric, min_value, max_value, warn_min, warn_max, enabled)
-        VALUES (?,?,?,?,?,?,1)
-    """, (site_id, "temp_c", 18, 28, 19, 27))
-    cur.execute("""
-        INSERT INTO thresholds(site_id, metric, min_value, max_value, warn_min, warn_max, enabled)
-        VALUES (?,?,?,?,?,?,1)
-    """, (site_id, "hum_pct", 45, 70, 50, 65))
-
-    # Fuente demo MANUAL
-    config = {"note": "Fuente demo. En producción se reemplaza por HTTP/MQTT/Modbus."}
-    cur.execute("""
-        INSERT INTO sensor_sources(site_id, name, protocol, config_json, enabled)
-        VALUES (?,?,?,?,1)
-    """, (site_id, "Sensores Demo", "MANUAL", json.dumps(config)))
-
-    source_id = cur.lastrowid
-
-    # Lecturas demo
-    now = datetime.now()
-    for i in range(48):
-        ts = (now - timedelta(minutes=30*i)).isoformat(timespec="seconds")
-        # valores semi-realistas
-        temp = 22.0 + (i % 6) * 0.2
-        hum = 58.0 + (i % 5) * 0.6
-        cur.execute("""
-            INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_json)
-            VALUES (?,?,?,?,?,?)
-        """, (site_id, source_id, ts, "temp_c", temp, None))
-        cur.execute("""
-            INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_json)
-            VALUES (?,?,?,?,?,?)
-        """, (site_id, source_id, ts, "hum_pct", hum, None))
-
-    # Mantenimiento demo
-    cur.execute("""
-        INSERT INTO maintenance(site_id, equipment_id, type, status, priority, scheduled_for, description, next_due)
-        VALUES (?,?,?,?,?,?,?,?)
-    """, (site_id, 1, "Preventivo", "Programado", "Media",
-          (now + timedelta(days=7)).date().isoformat(),
-          "Revisión controlador temperatura / limpieza sensores / verificación relés",
-          (now + timedelta(days=90)).date().isoformat()))
-
-    conn.commit()
-
 
 # -----------------------------
-# Lecturas/umbral/alertas
+# UI: Sidebar selección de sitio
 # -----------------------------
-def get_sites(conn: sqlite3.Connection) -> pd.DataFrame:
-    return pd.read_sql_query("""
-        SELECT s.id AS site_id, s.name AS site_name, s.type, c.name AS client_name
-        FROM sites s
-        JOIN clients c ON c.id = s.client_id
-        ORDER BY c.name, s.name
-    """, conn)
-
-
-def get_latest_metrics(conn: sqlite3.Connection, site_id: int) -> pd.DataFrame:
-    # última lectura por métrica
-    return pd.read_sql_query("""
-        SELECT metric, value, ts
-        FROM sensor_readings
-        WHERE site_id = ?
-        AND ts IN (
-            SELECT MAX(ts) FROM sensor_readings r2
-            WHERE r2.site_id = sensor_readings.site_id
-            AND r2.metric = sensor_readings.metric
-        )
-        ORDER BY metric
-    """, conn, params=(site_id,))
-
-
-def get_history(conn: sqlite3.Connection, site_id: int, metric: str, hours: int) -> pd.DataFrame:
-    since = (datetime.now() - timedelta(hours=hours)).isoformat(timespec="seconds")
-    return pd.read_sql_query("""
-        SELECT ts, value
-        FROM sensor_readings
-        WHERE site_id = ? AND metric = ? AND ts >= ?
-        ORDER BY ts
-    """, conn, params=(site_id, metric, since))
-
-
-def get_thresholds(conn: sqlite3.Connection, site_id: int) -> pd.DataFrame:
-    return pd.read_sql_query("""
-        SELECT id, metric, min_value, max_value, warn_min, warn_max, enabled
-        FROM thresholds
-        WHERE site_id = ?
-        ORDER BY metric
-    """, conn, params=(site_id,))
+conn = db_connect()
+db_init(conn)
+seed_demo(conn)
 
 
-def evaluate_alerts(latest: pd.DataFrame, thr: pd.DataFrame) -> pd.DataFrame:
-    if latest.empty or thr.empty:
-        return pd.DataFrame(columns=["metric", "value", "status", "message"])
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_multi_history(site_id: int, metrics: Tuple[str, ...], hours: int, resolution: str, fill: str) -> pd.DataFrame:
+    return get_multi_history(conn, site_id, list(metrics), hours, resolution, fill)
 
-    tmap = {row["metric"]: row for _, row in thr.iterrows()}
-    alerts = []
-    for _, r in latest.iterrows():
-        metric = r["metric"]
-        val = float(r["value"])
-        if metric not in tmap or int(tmap[metric]["enabled"]) != 1:
-            continue
 
-        tr = tmap[metric]
-        mn, mx = tr["min_value"], tr["max_value"]
-        wmn, wmx = tr["warn_min"], tr["warn_max"]
+@st.cache_resource
+def get_edge_buffer() -> EdgeBuffer:
+    return EdgeBuffer()
 
-        status = "OK"
-        msg = "Dentro de rango."
-        # Crítico
-        if (mn is not None and val < mn) or (mx is not None and val > mx):
-            status = "CRITICO"
-            msg = f"Fuera de rango crítico [{mn}, {mx}]"
-        # Advertencia
-        elif (wmn is not None and val < wmn) or (wmx is not None and val > wmx):
-            status = "ADVERTENCIA"
-            msg = f"Cerca de límites [{wmn}, {wmx}]"
 
-        alerts.append({"metric": metric, "value": val, "status": status, "message": msg})
-    return pd.DataFrame(alerts)
+# Las lecturas entran primero al buffer local y el drenador las escribe. Su
+# conexión no espera el lock: con la BD ocupada el rerun no se bloquea.
+edge_buffer = get_edge_buffer()
+drain_conn = db_connect(timeout=DRAIN_BUSY_TIMEOUT_S)
 
 
-# -----------------------------
-# Conectores de sensores (MVP)
-# -----------------------------
-def fetch_http_readings(url: str, headers_json: str, timeout_s: int = 5) -> Tuple[bool, str, List[Dict[str, Any]]]:
-    """
-    Espera JSON tipo:
-      [{"metric":"temp_c","value":22.1,"ts":"2026-01-04T10:00:00"} , ...]
-    """
+def drain_edge_buffer() -> None:
     try:
-        headers = json.loads(headers_json) if headers_json.strip() else {}
-        resp = requests.get(url, headers=headers, timeout=timeout_s)
-        resp.raise_for_status()
-        data = resp.json()
-        if not isinstance(data, list):
-            return False, "Respuesta no es lista JSON.", []
-        return True, "OK", data
+        if edge_buffer.pending() and edge_buffer.drain(drain_conn):
+            cached_multi_history.clear()
     except Exception as e:
-        return False, f"HTTP error: {e}", []
+        # Un fallo al drenar no debe tumbar la página; se reintenta en el próximo rerun
+        st.sidebar.error(f"No se pudo vaciar el buffer local: {e}")
 
 
-def mqtt_help_text() -> str:
-    return (
-        "MQTT: en este MVP mostramos configuración. Para ingestión continua, "
-        "lo ideal es un 'collector' externo (servicio) que escriba en la BD."
-    )
-
-
-def modbus_read_example(host: str, port: int, unit_id: int, address: int, count: int) -> Tuple[bool, str, List[int]]:
-    if ModbusTcpClient is None:
-        return False, "pymodbus no está instalado.", []
-    try:
-        client = ModbusTcpClient(host=host, port=port, timeout=3)
-        if not client.connect():
-            return False, "No se pudo conectar a Modbus TCP.", []
-        rr = client.read_holding_registers(address=address, count=count, slave=unit_id)
-        client.close()
-        if rr.isError():
-            return False, f"Error Modbus: {rr}", []
-        return True, "OK", list(rr.registers)
-    except Exception as e:
-        return False, f"Modbus error: {e}", []
-
-
-def save_readings(conn: sqlite3.Connection, site_id: int, source_id: int, readings: List[Dict[str, Any]]) -> Tuple[int, int]:
-    """
-    readings: lista dict con metric, value y opcional ts
-    """
-    ok = 0
-    bad = 0
-    cur = conn.cursor()
-    for r in readings:
-        try:
-            metric = str(r["metric"])
-            value = float(r["value"])
-            ts = r.get("ts") or datetime.now().isoformat(timespec="seconds")
-            meta = {k: v for k, v in r.items() if k not in ("metric", "value", "ts")}
-            cur.execute("""
-                INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_json)
-                VALUES (?,?,?,?,?,?)
-            """, (site_id, source_id, ts, metric, value, json.dumps(meta) if meta else None))
-            ok += 1
-        except Exception:
-            bad += 1
-    conn.commit()
-    return ok, bad
-
+drain_edge_buffer()
 
-# -----------------------------
-# UI: Sidebar selección de sitio
-# -----------------------------
-conn = db_connect()
-db_init(conn)
-seed_demo(conn)
 
 sites = get_sites(conn)
 if sites.empty:
@@ -401,16 +118,36 @@ if page == "Dashboard":
         st.dataframe(alerts, use_container_width=True, hide_index=True)
 
     st.subheader("Tendencias")
-    metric_choice = st.selectbox("Métrica", ["temp_c", "hum_pct"])
-    hours = st.slider("Ventana (horas)", 6, 72, 24, 6)
-    hist = get_history(conn, selected_site_id, metric_choice, hours)
-    if hist.empty:
+    site_type = sites[sites.site_id == selected_site_id].iloc[0].type
+    metric_options = TREND_METRICS + derived_names(site_type)
+    metric_choice = st.multiselect("Métricas", metric_options, default=["temp_c", "hum_pct"])
+    t1, t2, t3 = st.columns(3)
+    hours = t1.slider("Ventana (horas)", 6, 72, 24, 6)
+    resolution = t2.selectbox("Resolución", ["5min", "15min", "30min", "1h"], index=1)
+    fill = t3.selectbox("Relleno de huecos", GAP_FILLS)
+    # Se cachea con todas las opciones: activar/desactivar series no vuelve a la BD
+    grid = cached_multi_history(selected_site_id, tuple(metric_options), hours, resolution, fill)
+    grid = grid[[m for m in metric_choice if m in grid.columns]]
+    if grid.empty or grid.dropna(how="all").empty:
         st.warning("No hay datos en el rango.")
     else:
-        hist["ts"] = pd.to_datetime(hist["ts"])
-        fig = px.line(hist, x="ts", y="value", title=f"Histórico {metric_choice}")
+        fig = go.Figure()
+        for i, m in enumerate(grid.columns):
+            axis = "y" if i == 0 else f"y{i + 1}"
+            fig.add_trace(go.Scatter(x=grid.index, y=grid[m], name=m, yaxis=axis, connectgaps=False))
+            layout_axis = {"title": m, "side": "left" if i % 2 == 0 else "right"}
+            if i > 0:
+                layout_axis.update(overlaying="y", anchor="free", autoshift=True)
+            fig.update_layout(**{f"yaxis{i + 1 if i else ''}": layout_axis})
+        fig.update_layout(title=f"Histórico {hours} h ({resolution})", legend={"orientation": "h"})
         st.plotly_chart(fig, use_container_width=True)
 
+        if len(grid.columns) > 1:
+            st.caption("Correlación entre métricas (grilla común)")
+            corr = grid.corr()
+            st.plotly_chart(px.imshow(corr, text_auto=".2f", zmin=-1, zmax=1, color_continuous_scale="RdBu"),
+                            use_container_width=True)
+
 # -----------------------------
 # SENSORES & CONEXIONES
 # -----------------------------
@@ -505,8 +242,19 @@ elif page == "Sensores & Conexiones":
                 st.warning("Crea primero la fuente para asociar lecturas.")
             else:
                 source_id = int(src.iloc[0].id)
-                okc, badc = save_readings(conn, selected_site_id, source_id, readings_to_save)
-                st.success(f"Lecturas guardadas: {okc}. Fallidas: {badc}.")
+                try:
+                    okc, badc = edge_buffer.append_readings(selected_site_id, source_id, readings_to_save)
+                except BufferFull as full:
+                    st.error(f"Buffer local lleno (BD no disponible hace rato): {full}")
+                else:
+                    rejected = edge_buffer.rejected
+                    drain_edge_buffer()
+                    badc += edge_buffer.rejected - rejected
+                    if edge_buffer.pending():
+                        st.warning(f"Lecturas recibidas: {okc}. Fallidas: {badc}. BD ocupada: "
+                                   f"{edge_buffer.pending()} en buffer local, se guardan al liberarse.")
+                    else:
+                        st.success(f"Lecturas guardadas: {okc}. Fallidas: {badc}.")
 
     with tab3:
         st.subheader("Modbus TCP (lectura de registros - demo)")
@@ -717,4 +465,6 @@ elif page == "Reportes":
     )
 
 st.sidebar.markdown("---")
+if edge_buffer.pending():
+    st.sidebar.warning(f"Buffer local: {edge_buffer.pending()} lecturas pendientes de guardar.")
 st.sidebar.caption("MVP Streamlit — Ecopol SmartFarm")
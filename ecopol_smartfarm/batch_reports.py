@@ -0,0 +1,215 @@
+"""
+Reportes semanales por sitio (postventa), en lote y fuera de línea.
+
+Copia la BD a una instantánea de solo lectura, reparte los sitios en un pool
+de procesos y omite los sitios cuyos datos no cambiaron desde la última
+corrida (manifest.json). Deja timings.csv con el tiempo de cada sitio.
+
+Uso:
+  python batch_reports.py --out reportes [--db data/demo.sqlite] [--hours 168]
+                          [--workers 8] [--charts] [--force]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from html import escape
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+import plotly.express as px
+
+from plotly.offline import get_plotlyjs
+
+from db import DB_PATH, evaluate_alerts, get_latest_metrics, get_multi_history, get_thresholds
+
+MANIFEST = "manifest.json"
+SNAPSHOT = "_snapshot.sqlite"
+PLOTLY_JS = "plotly.min.js"  # una copia junto a los reportes: se ven sin conexión
+
+# Conexión de solo lectura por proceso (ver _init_worker)
+_conn: Optional[sqlite3.Connection] = None
+_opts: Dict[str, Any] = {}
+
+
+def make_snapshot(db_path: str, out_dir: str) -> str:
+    # backup() entrega una copia consistente aunque la app siga escribiendo
+    path = os.path.join(out_dir, SNAPSHOT)
+    if os.path.exists(path):
+        os.remove(path)
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(path)
+    src.backup(dst)
+    dst.close()
+    src.close()
+    return path
+
+
+def site_fingerprints(conn: sqlite3.Connection, hours: int) -> Dict[int, str]:
+    """
+    Huella de los datos que entran al reporte de cada sitio (encabezado,
+    lecturas, umbrales y tabla de mantenimiento). Si no cambia, el reporte
+    anterior sigue siendo válido.
+    """
+    parts: Dict[int, List[str]] = {int(r[0]): [f"h={hours}"] for r in conn.execute("SELECT id FROM sites")}
+    queries = [
+        "SELECT s.id, s.name, s.type, c.id, c.name FROM sites s JOIN clients c ON c.id = s.client_id",
+        "SELECT site_id, COUNT(*), MAX(id), MAX(ts), TOTAL(value) FROM sensor_readings GROUP BY site_id",
+        "SELECT site_id, COUNT(*), GROUP_CONCAT(metric || quote(min_value) || quote(max_value)"
+        " || quote(warn_min) || quote(warn_max) || enabled) FROM thresholds GROUP BY site_id",
+        "SELECT m.site_id, COUNT(*), GROUP_CONCAT(m.id || quote(m.type) || quote(m.status) || quote(m.priority)"
+        " || quote(m.scheduled_for) || quote(m.performed_at) || quote(m.next_due) || quote(m.description)"
+        " || quote(e.name), '|') FROM maintenance m LEFT JOIN equipment e ON e.id = m.equipment_id"
+        " GROUP BY m.site_id",
+    ]
+    for q in queries:
+        for row in conn.execute(q):
+            if int(row[0]) in parts:
+                parts[int(row[0])].append(repr(row[1:]))
+    return {site_id: "|".join(p) for site_id, p in parts.items()}
+
+
+def _init_worker(snapshot_path: str, opts: Dict[str, Any]) -> None:
+    global _conn, _opts
+    _conn = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    _opts = opts
+
+
+def _html_table(df: pd.DataFrame) -> str:
+    if df.empty:
+        return "<p>Sin datos.</p>"
+    return df.to_html(index=False, border=0, classes="tabla")
+
+
+def render_site_report(site: Tuple[int, str, str, str]) -> Tuple[int, float, str]:
+    site_id, site_name, site_type, client_name = site
+    t0 = time.perf_counter()
+    conn = _conn
+    hours = _opts["hours"]
+    site_dir = os.path.join(_opts["out"], f"site_{site_id}")
+    os.makedirs(site_dir, exist_ok=True)
+    try:
+        latest = get_latest_metrics(conn, site_id)
+        alerts = evaluate_alerts(latest, get_thresholds(conn, site_id))
+        maint = pd.read_sql_query("""
+            SELECT m.type, m.status, m.priority, m.scheduled_for, m.performed_at,
+                   e.name AS equipment, m.description, m.next_due
+            FROM maintenance m
+            LEFT JOIN equipment e ON e.id = m.equipment_id
+            WHERE m.site_id = ?
+            ORDER BY COALESCE(m.scheduled_for, m.performed_at) DESC
+        """, conn, params=(site_id,))
+        since = (_opts["now"] - timedelta(hours=hours)).isoformat(timespec="seconds")
+        hist = pd.read_sql_query("""
+            SELECT ts, metric, value
+            FROM sensor_readings
+            WHERE site_id = ? AND ts >= ?
+            ORDER BY ts
+        """, conn, params=(site_id, since))
+        hist.to_csv(os.path.join(site_dir, "lecturas.csv"), index=False)
+
+        charts = []
+        if not hist.empty:
+            # El gráfico usa la grilla remuestreada; el CSV conserva las lecturas crudas
+            resolution = "1h" if hours > 48 else "15min"
+            grid = get_multi_history(conn, site_id, sorted(hist["metric"].unique()), hours, resolution, "none",
+                                     now=_opts["now"])
+            long = grid.rename_axis("ts").reset_index().melt(id_vars="ts", var_name="metric", value_name="value")
+            fig = px.line(long, x="ts", y="value", color="metric", title=f"Histórico {hours} h ({resolution})")
+            charts.append(fig.to_html(full_html=False, include_plotlyjs=f"../{PLOTLY_JS}"))
+            if _opts["charts"]:
+                try:
+                    fig.write_image(os.path.join(site_dir, "historico.png"))
+                except Exception:
+                    pass  # kaleido no instalado: se omite la imagen estática
+
+        active = int((alerts.status != "OK").sum()) if not alerts.empty else 0
+        html = f"""<!DOCTYPE html>
+<html lang="es"><head><meta charset="utf-8">
+<title>Reporte {escape(site_name)}</title></head>
+<body>
+<h1>{escape(client_name)} — {escape(site_name)} ({escape(site_type or "")})</h1>
+<p>Período: últimas {hours} h hasta {_opts["now"]:%Y-%m-%d %H:%M}. Alertas activas: {active}.</p>
+<h2>Resumen de condiciones</h2>
+{_html_table(latest)}
+<h2>Alertas evaluadas</h2>
+{_html_table(alerts)}
+<h2>Mantenimiento</h2>
+{_html_table(maint)}
+<h2>Tendencias</h2>
+{"".join(charts) or "<p>Sin lecturas en el período.</p>"}
+</body></html>
+"""
+        with open(os.path.join(site_dir, "reporte.html"), "w", encoding="utf-8") as fh:
+            fh.write(html)
+        status = "OK"
+    except Exception as e:
+        status = f"ERROR: {e}"
+    return site_id, time.perf_counter() - t0, status
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Reportes postventa por sitio (lote).")
+    ap.add_argument("--db", default=DB_PATH)
+    ap.add_argument("--out", default="reportes")
+    ap.add_argument("--hours", type=int, default=168)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    ap.add_argument("--charts", action="store_true", help="Exporta PNG (requiere kaleido).")
+    ap.add_argument("--force", action="store_true", help="Regenera aunque no haya cambios.")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, PLOTLY_JS), "w", encoding="utf-8") as fh:
+        fh.write(get_plotlyjs())
+    snapshot = make_snapshot(args.db, args.out)
+
+    snap = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    sites = snap.execute("""
+        SELECT s.id, s.name, s.type, c.name
+        FROM sites s
+        JOIN clients c ON c.id = s.client_id
+        ORDER BY s.id
+    """).fetchall()
+    fingerprints = site_fingerprints(snap, args.hours)
+    snap.close()
+
+    manifest_path = os.path.join(args.out, MANIFEST)
+    previous: Dict[str, str] = {}
+    if os.path.exists(manifest_path) and not args.force:
+        with open(manifest_path, encoding="utf-8") as fh:
+            previous = json.load(fh)
+    todo = [s for s in sites if previous.get(str(s[0])) != fingerprints[s[0]]]
+    print(f"{len(sites)} sitios, {len(sites) - len(todo)} sin cambios, {len(todo)} a generar.")
+
+    opts = {"out": args.out, "hours": args.hours, "charts": args.charts, "now": datetime.now()}
+    results: List[Tuple[int, float, str]] = []
+    if todo:
+        chunksize = max(1, len(todo) // (args.workers * 4))
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(snapshot, opts)) as pool:
+            results = list(pool.map(render_site_report, todo, chunksize=chunksize))
+
+    manifest = {k: v for k, v in previous.items() if int(k) in fingerprints}
+    for site_id, _, status in results:
+        if status == "OK":
+            manifest[str(site_id)] = fingerprints[site_id]
+    with open(manifest_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh)
+
+    timings = pd.DataFrame(results, columns=["site_id", "seconds", "status"])
+    timings.to_csv(os.path.join(args.out, "timings.csv"), index=False)
+    os.remove(snapshot)
+
+    errors = int((timings.status != "OK").sum()) if not timings.empty else 0
+    if not timings.empty:
+        print(f"Por sitio: p50 {timings.seconds.median():.3f} s, máx {timings.seconds.max():.3f} s "
+              f"(site {int(timings.loc[timings.seconds.idxmax(), 'site_id'])}).")
+    print(f"Generados {len(results) - errors}, errores {errors}, total {time.perf_counter() - t0:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark del buffer de lecturas: append sostenido, recuperación al reabrir
+y velocidad de reenvío a sensor_readings.
+
+Uso:
+  python bench_edge_buffer.py [n_lecturas]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from db import db_init
+from edge_buffer import EdgeBuffer
+
+METRICS = ["temp_c", "hum_pct", "co2_ppm", "nh3_ppm", "water_lpm"]
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    start = datetime(2026, 1, 1)
+    ts_list = [(start + timedelta(seconds=i)).isoformat(timespec="seconds") for i in range(n // len(METRICS) + 1)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.sqlite"))
+        db_init(conn)
+        conn.execute("INSERT INTO clients(name) VALUES ('bench')")
+        conn.execute("INSERT INTO sites(client_id, name) VALUES (1, 'bench')")
+        conn.execute("INSERT INTO sensor_sources(site_id, name, protocol, config_json) VALUES (1, 'bench', 'HTTP', '{}')")
+        conn.commit()
+
+        path = os.path.join(tmp, "edge.ring")
+        buf = EdgeBuffer(path, capacity=n + 1)
+        t0 = time.perf_counter()
+        for i in range(n):
+            buf.append(1, 1, METRICS[i % len(METRICS)], 20.0 + (i % 97) * 0.1, ts_list[i // len(METRICS)])
+        dt_append = time.perf_counter() - t0
+        buf.close()
+
+        # Reapertura = recuperación tras caída (sin drenar)
+        t0 = time.perf_counter()
+        buf = EdgeBuffer(path)
+        dt_recover = time.perf_counter() - t0
+        assert buf.pending() == n, buf.pending()
+
+        t0 = time.perf_counter()
+        drained = buf.drain(conn)
+        dt_drain = time.perf_counter() - t0
+        rows = conn.execute("SELECT COUNT(*) FROM sensor_readings WHERE metric IN (%s)"
+                            % ",".join("?" * len(METRICS)), METRICS).fetchone()[0]
+        buf.close()
+
+    print(f"append   {n / dt_append:12.0f} lecturas/s")
+    print(f"recover  {dt_recover:12.3f} s ({n} pendientes)")
+    print(f"drain    {drained / dt_drain:12.0f} lecturas/s ({rows} filas)")
+
+
+if __name__ == "__main__":
+    main()
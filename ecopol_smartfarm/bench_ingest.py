@@ -0,0 +1,101 @@
+"""
+Benchmark de ingesta: tamaño de BD y lecturas/s guardando la metadata
+por lectura (meta_json, esquema anterior) vs internada en reading_meta.
+Ambos pasan por el mismo save_readings; solo cambia la columna de metadata.
+
+Uso:
+  python bench_ingest.py [n_lecturas]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import db
+
+METRICS = ["temp_c", "hum_pct", "co2_ppm", "nh3_ppm", "water_lpm"]
+BATCH = 500
+
+
+def gateway_readings(n: int, n_devices: int = 20) -> List[Dict[str, Any]]:
+    start = datetime(2026, 1, 1)
+    out = []
+    for i in range(n):
+        dev = i % n_devices
+        out.append({
+            "metric": METRICS[i % len(METRICS)],
+            "value": 20.0 + (i % 97) * 0.1,
+            "ts": (start + timedelta(seconds=i // len(METRICS))).isoformat(timespec="seconds"),
+            "site": "Sitio 1 - Galpones",
+            "device": f"gw-{dev:03d}",
+            "firmware": "2.4.1",
+            "unit": "SI",
+        })
+    return out
+
+
+def new_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    db.db_init(conn)
+    conn.execute("INSERT INTO clients(name) VALUES ('bench')")
+    conn.execute("INSERT INTO sites(client_id, name) VALUES (1, 'bench')")
+    conn.execute("INSERT INTO sensor_sources(site_id, name, protocol, config_json) VALUES (1, 'bench', 'HTTP', '{}')")
+    conn.commit()
+    return conn
+
+
+LEGACY_UPSERT_SQL = db.UPSERT_READING_SQL.replace("meta_id", "meta_json")
+
+
+@contextmanager
+def legacy_meta_layout():
+    """
+    Mismo save_readings (validación, LRU, upsert), pero el "id" de meta es el
+    propio JSON y se escribe en meta_json: solo cambia la columna de metadata.
+    """
+    saved = db.UPSERT_READING_SQL, db._intern_meta
+    db.UPSERT_READING_SQL = LEGACY_UPSERT_SQL
+    db._intern_meta = lambda conn, canonical: canonical
+    try:
+        yield
+    finally:
+        db.UPSERT_READING_SQL, db._intern_meta = saved
+
+
+def ingest(conn: sqlite3.Connection, readings: List[Dict[str, Any]]) -> None:
+    for i in range(0, len(readings), BATCH):
+        db.save_readings(conn, 1, 1, readings[i:i + BATCH])
+
+
+def ingest_legacy(conn: sqlite3.Connection, readings: List[Dict[str, Any]]) -> None:
+    with legacy_meta_layout():
+        ingest(conn, readings)
+
+
+def run(label: str, fn, readings: List[Dict[str, Any]], tmp: str) -> None:
+    path = os.path.join(tmp, f"{label}.sqlite")
+    conn = new_db(path)
+    db.clear_ingest_caches()
+    t0 = time.perf_counter()
+    fn(conn, readings)
+    dt = time.perf_counter() - t0
+    conn.execute("VACUUM")
+    conn.close()
+    size_mb = os.path.getsize(path) / 1e6
+    print(f"{label:10s} {len(readings) / dt:10.0f} lecturas/s  {size_mb:8.2f} MB")
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    readings = gateway_readings(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        run("meta_json", ingest_legacy, readings, tmp)
+        run("interned", ingest, readings, tmp)
+
+
+if __name__ == "__main__":
+    main()
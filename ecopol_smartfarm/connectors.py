@@ -0,0 +1,90 @@
+import json
+from typing import Dict, Any, Optional, Tuple, List
+
+import requests
+
+# Opcionales según conector
+try:
+    import paho.mqtt.client as mqtt
+except Exception:
+    mqtt = None
+
+try:
+    from pymodbus.client import ModbusTcpClient
+except Exception:
+    ModbusTcpClient = None
+
+
+# -----------------------------
+# Conectores de sensores (MVP)
+# -----------------------------
+def fetch_http_readings(url: str, headers_json: str, timeout_s: int = 5) -> Tuple[bool, str, List[Dict[str, Any]]]:
+    """
+    Espera JSON tipo:
+      [{"metric":"temp_c","value":22.1,"ts":"2026-01-04T10:00:00"} , ...]
+    """
+    try:
+        headers = json.loads(headers_json) if headers_json.strip() else {}
+        resp = requests.get(url, headers=headers, timeout=timeout_s)
+        resp.raise_for_status()
+        data = resp.json()
+        if not isinstance(data, list):
+            return False, "Respuesta no es lista JSON.", []
+        return True, "OK", data
+    except Exception as e:
+        return False, f"HTTP error: {e}", []
+
+
+def mqtt_help_text() -> str:
+    return (
+        "MQTT: en este MVP mostramos configuración. Para ingestión continua, "
+        "lo ideal es un 'collector' externo (servicio) que escriba en la BD."
+    )
+
+
+def modbus_read_example(host: str, port: int, unit_id: int, address: int, count: int) -> Tuple[bool, str, List[int]]:
+    if ModbusTcpClient is None:
+        return False, "pymodbus no está instalado.", []
+    try:
+        client = ModbusTcpClient(host=host, port=port, timeout=3)
+        if not client.connect():
+            return False, "No se pudo conectar a Modbus TCP.", []
+        rr = client.read_holding_registers(address=address, count=count, slave=unit_id)
+        client.close()
+        if rr.isError():
+            return False, f"Error Modbus: {rr}", []
+        return True, "OK", list(rr.registers)
+    except Exception as e:
+        return False, f"Modbus error: {e}", []
+
+
+def mqtt_payload_to_reading(payload: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Payload sugerido (JSON):
+      {"metric":"temp_c","value":22.3,"ts":"2026-01-04T12:00:00","site":"Sitio 1"}
+    """
+    try:
+        data = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(data, dict) or "metric" not in data or "value" not in data:
+        return None
+    return data
+
+
+# Registro -> (métrica, factor). Ej: reg0 = temp*10
+MODBUS_REGISTER_MAP: List[Tuple[str, float]] = [
+    ("temp_c", 10.0),
+    ("hum_pct", 10.0),
+    ("co2_ppm", 1.0),
+    ("nh3_ppm", 10.0),
+    ("water_lpm", 10.0),
+]
+
+
+def registers_to_readings(regs: List[int], ts: Optional[str] = None,
+                          register_map: Optional[List[Tuple[str, float]]] = None) -> List[Dict[str, Any]]:
+    out = []
+    for (metric, scale), raw in zip(register_map or MODBUS_REGISTER_MAP, regs):
+        out.append({"metric": metric, "value": raw / scale, "ts": ts})
+    return out
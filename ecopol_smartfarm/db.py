@@ -0,0 +1,654 @@
+import hashlib
+import json
+import numbers
+import sqlite3
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, Optional, Tuple, List
+
+import pandas as pd
+
+from derived import formulas_for
+
+
+# -----------------------------
+# DB simple (SQLite)
+# -----------------------------
+DB_PATH = "data/demo.sqlite"
+
+UPSERT_READING_SQL = """
+    INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_id)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(site_id, IFNULL(source_id, -1), metric, ts) DO UPDATE SET
+      value = excluded.value,
+      meta_id = excluded.meta_id
+    WHERE value IS NOT excluded.value OR meta_id IS NOT excluded.meta_id
+"""
+
+# Reenvío desde el buffer local: un meta_id NULL no borra el ya guardado
+# (la misma lectura pudo entrar antes directo con sus metadatos)
+REPLAY_READING_SQL = """
+    INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_id)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(site_id, IFNULL(source_id, -1), metric, ts) DO UPDATE SET
+      value = excluded.value,
+      meta_id = COALESCE(excluded.meta_id, meta_id)
+    WHERE value IS NOT excluded.value OR meta_id IS NOT COALESCE(excluded.meta_id, meta_id)
+"""
+
+# PRAGMA user_version desde el cual meta_json ya está migrado a reading_meta
+META_SCHEMA_VERSION = 1
+
+# source_id puede ser NULL y SQLite trata los NULL como distintos en un índice
+# UNIQUE: se indexa IFNULL(source_id, -1) para que ON CONFLICT también aplique.
+READINGS_KEY_DDL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_readings_key
+    ON sensor_readings(site_id, IFNULL(source_id, -1), metric, ts)
+"""
+
+
+def db_connect(timeout: float = 5.0) -> sqlite3.Connection:
+    # timeout: espera máxima por el lock de escritura (busy timeout de sqlite)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=timeout)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def db_init(conn: sqlite3.Connection) -> None:
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS clients(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          name TEXT NOT NULL,
+          phone TEXT,
+          email TEXT,
+          address TEXT,
+          notes TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS sites(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          client_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          location TEXT,
+          type TEXT, -- 'Avícola' / 'Porcina' / 'Mixta'
+          FOREIGN KEY(client_id) REFERENCES clients(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS equipment(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          site_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          category TEXT, -- 'Climatización' 'Alimentación' 'Agua' 'Calefacción' 'Sensores'
+          model TEXT,
+          serial TEXT,
+          install_date TEXT,
+          status TEXT, -- 'Operativo' 'En observación' 'Fuera de servicio'
+          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS sensor_sources(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          site_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          protocol TEXT NOT NULL, -- 'HTTP' 'MQTT' 'MODBUS' 'CSV' 'MANUAL' 'DERIVED'
+          config_json TEXT NOT NULL,
+          enabled INTEGER NOT NULL DEFAULT 1,
+          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS reading_meta(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          hash TEXT NOT NULL UNIQUE, -- sha1 del JSON canónico
+          meta_json TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS sensor_readings(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          site_id INTEGER NOT NULL,
+          source_id INTEGER,
+          ts TEXT NOT NULL,
+          metric TEXT NOT NULL, -- 'temp_c', 'hum_pct', 'co2_ppm', 'nh3_ppm', 'water_lpm', etc.
+          value REAL NOT NULL,
+          meta_json TEXT, -- legado; las lecturas nuevas usan meta_id
+          meta_id INTEGER,
+          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE,
+          FOREIGN KEY(source_id) REFERENCES sensor_sources(id) ON DELETE SET NULL,
+          FOREIGN KEY(meta_id) REFERENCES reading_meta(id)
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_readings_site_metric_ts
+        ON sensor_readings(site_id, metric, ts);
+
+        CREATE TABLE IF NOT EXISTS thresholds(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          site_id INTEGER NOT NULL,
+          metric TEXT NOT NULL,
+          min_value REAL,
+          max_value REAL,
+          warn_min REAL,
+          warn_max REAL,
+          enabled INTEGER NOT NULL DEFAULT 1,
+          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE
+        );
+
+        CREATE TABLE IF NOT EXISTS maintenance(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          site_id INTEGER NOT NULL,
+          equipment_id INTEGER,
+          type TEXT NOT NULL, -- 'Preventivo' 'Correctivo'
+          status TEXT NOT NULL, -- 'Programado' 'En curso' 'Cerrado'
+          priority TEXT NOT NULL, -- 'Baja' 'Media' 'Alta'
+          scheduled_for TEXT,
+          performed_at TEXT,
+          description TEXT,
+          actions_taken TEXT,
+          parts_used TEXT,
+          next_due TEXT,
+          FOREIGN KEY(site_id) REFERENCES sites(id) ON DELETE CASCADE,
+          FOREIGN KEY(equipment_id) REFERENCES equipment(id) ON DELETE SET NULL
+        );
+        """
+    )
+    conn.commit()
+    ensure_reading_meta(conn)
+    ensure_readings_key(conn)
+
+
+def ensure_readings_key(conn: sqlite3.Connection) -> None:
+    """
+    Llave de idempotencia de lecturas: (site_id, source_id, metric, ts).
+    Si la BD es anterior y tiene duplicados, se deduplica antes de crear el índice.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'ux_readings_key'").fetchone()
+    if row and "IFNULL" not in row[0]:
+        # Índice anterior sobre source_id directo: no deduplicaba source_id NULL
+        conn.execute("DROP INDEX ux_readings_key")
+    try:
+        conn.execute(READINGS_KEY_DDL)
+    except sqlite3.IntegrityError:
+        dedupe_readings(conn)
+        conn.execute(READINGS_KEY_DDL)
+    conn.commit()
+
+
+def ensure_reading_meta(conn: sqlite3.Connection) -> None:
+    """
+    Migra BDs anteriores: agrega sensor_readings.meta_id y mueve meta_json
+    (texto repetido por lectura) a la tabla reading_meta. Corre una sola vez
+    (PRAGMA user_version), no en cada rerun de la app.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= META_SCHEMA_VERSION:
+        return
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(sensor_readings)")]
+    if "meta_id" not in cols:
+        conn.execute("ALTER TABLE sensor_readings ADD COLUMN meta_id INTEGER REFERENCES reading_meta(id)")
+
+    # Una pasada por id; el cache evita re-hashear payloads repetidos
+    ids: Dict[str, int] = {}
+    updates = []
+    legacy = conn.execute("SELECT id, meta_json FROM sensor_readings WHERE meta_json IS NOT NULL").fetchall()
+    for row_id, raw in legacy:
+        meta_id = ids.get(raw)
+        if meta_id is None:
+            try:
+                meta = json.loads(raw)
+            except ValueError:
+                meta = {"raw": raw}
+            meta_id = ids[raw] = _intern_meta(conn, canonical_meta(meta))
+        updates.append((meta_id, row_id))
+    conn.executemany("UPDATE sensor_readings SET meta_id = ?, meta_json = NULL WHERE id = ?", updates)
+    conn.execute(f"PRAGMA user_version = {META_SCHEMA_VERSION}")
+    conn.commit()
+
+
+def dedupe_readings(conn: sqlite3.Connection) -> int:
+    """
+    Elimina lecturas repetidas dejando la última escrita (mayor id) por llave.
+    Retorna la cantidad de filas eliminadas.
+    """
+    cur = conn.execute("""
+        DELETE FROM sensor_readings
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM sensor_readings
+            GROUP BY site_id, source_id, metric, ts
+        )
+    """)
+    conn.commit()
+    return cur.rowcount
+
+
+def seed_demo(conn: sqlite3.Connection) -> None:
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM clients")
+    if cur.fetchone()[0] > 0:
+        return
+
+    # Cliente + sitio + equipos
+    cur.execute("INSERT INTO clients(name, phone, email, address, notes) VALUES (?,?,?,?,?)",
+                ("Granja Los Robles", "+56 9 1234 5678", "contacto@cliente.cl", "Región del Maule", "Cliente demo"))
+    client_id = cur.lastrowid
+
+    cur.execute("INSERT INTO sites(client_id, name, location, type) VALUES (?,?,?,?)",
+                (client_id, "Sitio 1 - Galpones", "Maule, Chile", "Avícola"))
+    site_id = cur.lastrowid
+
+    equipments = [
+        ("Controlador Temp ITC10", "Climatización", "ITC10", "SN-ITC10-001", "2025-11-01", "Operativo"),
+        ("Sistema Transporte Espiral", "Alimentación", "Spiral-01", "SN-SP-009", "2025-10-15", "Operativo"),
+        ("Línea de Bebederos", "Agua", "WaterLine-X", "SN-WL-120", "2025-10-20", "En observación"),
+        ("Radiador Infrarrojo", "Calefacción", "IR-Heat", "SN-IR-777", "2025-10-18", "Operativo"),
+    ]
+    for name, cat, model, serial, d, status in equipments:
+        cur.execute("""
+            INSERT INTO equipment(site_id, name, category, model, serial, install_date, status)
+            VALUES (?,?,?,?,?,?,?)
+        """, (site_id, name, cat, model, serial, d, status))
+
+    # Umbrales demo
+    cur.execute("""
+        INSERT INTO thresholds(site_id, metric, min_value, max_value, warn_min, warn_max, enabled)
+        VALUES (?,?,?,?,?,?,1)
+    """, (site_id, "temp_c", 18, 28, 19, 27))
+    cur.execute("""
+        INSERT INTO thresholds(site_id, metric, min_value, max_value, warn_min, warn_max, enabled)
+        VALUES (?,?,?,?,?,?,1)
+    """, (site_id, "hum_pct", 45, 70, 50, 65))
+    cur.execute("""
+        INSERT INTO thresholds(site_id, metric, min_value, max_value, warn_min, warn_max, enabled)
+        VALUES (?,?,?,?,?,?,1)
+    """, (site_id, "thi", None, 78, None, 72))
+
+    # Fuente demo MANUAL
+    config = {"note": "Fuente demo. En producción se reemplaza por HTTP/MQTT/Modbus."}
+    cur.execute("""
+        INSERT INTO sensor_sources(site_id, name, protocol, config_json, enabled)
+        VALUES (?,?,?,?,1)
+    """, (site_id, "Sensores Demo", "MANUAL", json.dumps(config)))
+
+    source_id = cur.lastrowid
+
+    # Lecturas demo
+    now = datetime.now()
+    written = []
+    for i in range(48):
+        ts = (now - timedelta(minutes=30*i)).isoformat(timespec="seconds")
+        # valores semi-realistas
+        temp = 22.0 + (i % 6) * 0.2
+        hum = 58.0 + (i % 5) * 0.6
+        cur.execute("""
+            INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_json)
+            VALUES (?,?,?,?,?,?)
+        """, (site_id, source_id, ts, "temp_c", temp, None))
+        cur.execute("""
+            INSERT INTO sensor_readings(site_id, source_id, ts, metric, value, meta_json)
+            VALUES (?,?,?,?,?,?)
+        """, (site_id, source_id, ts, "hum_pct", hum, None))
+        written += [("temp_c", ts), ("hum_pct", ts)]
+    update_derived_metrics(conn, site_id, written)
+
+    # Mantenimiento demo
+    cur.execute("""
+        INSERT INTO maintenance(site_id, equipment_id, type, status, priority, scheduled_for, description, next_due)
+        VALUES (?,?,?,?,?,?,?,?)
+    """, (site_id, 1, "Preventivo", "Programado", "Media",
+          (now + timedelta(days=7)).date().isoformat(),
+          "Revisión controlador temperatura / limpieza sensores / verificación relés",
+          (now + timedelta(days=90)).date().isoformat()))
+
+    conn.commit()
+
+
+# -----------------------------
+# Lecturas/umbral/alertas
+# -----------------------------
+def get_sites(conn: sqlite3.Connection) -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT s.id AS site_id, s.name AS site_name, s.type, c.name AS client_name
+        FROM sites s
+        JOIN clients c ON c.id = s.client_id
+        ORDER BY c.name, s.name
+    """, conn)
+
+
+def get_latest_metrics(conn: sqlite3.Connection, site_id: int) -> pd.DataFrame:
+    # última lectura por métrica
+    return pd.read_sql_query("""
+        SELECT metric, value, ts
+        FROM sensor_readings
+        WHERE site_id = ?
+        AND ts IN (
+            SELECT MAX(ts) FROM sensor_readings r2
+            WHERE r2.site_id = sensor_readings.site_id
+            AND r2.metric = sensor_readings.metric
+        )
+        ORDER BY metric
+    """, conn, params=(site_id,))
+
+
+def get_history(conn: sqlite3.Connection, site_id: int, metric: str, hours: int) -> pd.DataFrame:
+    since = (datetime.now() - timedelta(hours=hours)).isoformat(timespec="seconds")
+    return pd.read_sql_query("""
+        SELECT ts, value
+        FROM sensor_readings
+        WHERE site_id = ? AND metric = ? AND ts >= ?
+        ORDER BY ts
+    """, conn, params=(site_id, metric, since))
+
+
+TREND_METRICS = ["temp_c", "hum_pct", "co2_ppm", "nh3_ppm", "water_lpm"]
+GAP_FILLS = ["ffill", "interpolate", "none"]
+
+
+def get_multi_history(conn: sqlite3.Connection, site_id: int, metrics: List[str], hours: int,
+                      resolution: str = "15min", fill: str = "ffill", max_gap: int = 4,
+                      now: Optional[datetime] = None) -> pd.DataFrame:
+    """
+    Varias métricas en una sola consulta por rango (índice site_id, metric, ts),
+    pivoteadas y remuestreadas a una grilla común: índice ts, una columna por métrica.
+    fill: 'ffill' | 'interpolate' | 'none'; max_gap = períodos máximos a rellenar.
+    now: fin de la ventana (por defecto la hora actual).
+    """
+    metrics = list(metrics)
+    if not metrics:
+        return pd.DataFrame()
+    since = ((now or datetime.now()) - timedelta(hours=hours)).isoformat(timespec="seconds")
+    raw = pd.read_sql_query(f"""
+        SELECT ts, metric, value
+        FROM sensor_readings
+        WHERE site_id = ? AND metric IN ({",".join("?" * len(metrics))}) AND ts >= ?
+        ORDER BY ts
+    """, conn, params=(site_id, *metrics, since))
+    if raw.empty:
+        return pd.DataFrame(columns=metrics)
+
+    raw["ts"] = pd.to_datetime(raw["ts"])
+    wide = raw.pivot_table(index="ts", columns="metric", values="value", aggfunc="mean")
+    wide = wide.resample(resolution).mean().reindex(columns=metrics)
+    if fill == "ffill":
+        wide = wide.ffill(limit=max_gap)
+    elif fill == "interpolate":
+        wide = wide.interpolate(method="time", limit=max_gap, limit_area="inside")
+    wide.columns.name = None
+    return wide
+
+
+def get_thresholds(conn: sqlite3.Connection, site_id: int) -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT id, metric, min_value, max_value, warn_min, warn_max, enabled
+        FROM thresholds
+        WHERE site_id = ?
+        ORDER BY metric
+    """, conn, params=(site_id,))
+
+
+def evaluate_alerts(latest: pd.DataFrame, thr: pd.DataFrame) -> pd.DataFrame:
+    if latest.empty or thr.empty:
+        return pd.DataFrame(columns=["metric", "value", "status", "message"])
+
+    tmap = {row["metric"]: row for _, row in thr.iterrows()}
+    alerts = []
+    for _, r in latest.iterrows():
+        metric = r["metric"]
+        val = float(r["value"])
+        if metric not in tmap or int(tmap[metric]["enabled"]) != 1:
+            continue
+
+        tr = tmap[metric]
+        mn, mx = tr["min_value"], tr["max_value"]
+        wmn, wmx = tr["warn_min"], tr["warn_max"]
+
+        status = "OK"
+        msg = "Dentro de rango."
+        # Crítico
+        if (mn is not None and val < mn) or (mx is not None and val > mx):
+            status = "CRITICO"
+            msg = f"Fuera de rango crítico [{mn}, {mx}]"
+        # Advertencia
+        elif (wmn is not None and val < wmn) or (wmx is not None and val > wmx):
+            status = "ADVERTENCIA"
+            msg = f"Cerca de límites [{wmn}, {wmx}]"
+
+        alerts.append({"metric": metric, "value": val, "status": status, "message": msg})
+    return pd.DataFrame(alerts)
+
+
+# -----------------------------
+# Ingesta idempotente
+# -----------------------------
+class RecentKeyFilter:
+    """
+    LRU acotado de llaves recientes -> valor. Descarta en memoria los reintentos
+    idénticos (mismo gateway, mismo CSV) antes de llegar a SQLite.
+    """
+
+    def __init__(self, capacity: int = 100_000):
+        self.capacity = capacity
+        self._keys: "OrderedDict[Tuple[int, Optional[int], str, str], float]" = OrderedDict()
+
+    def seen(self, key: Tuple[int, Optional[int], str, str], value: float) -> bool:
+        prev = self._keys.get(key)
+        if prev is not None and prev == value:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: Tuple[int, Optional[int], str, str], value: float) -> None:
+        self._keys[key] = value
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.capacity:
+            self._keys.popitem(last=False)
+
+    def clear(self) -> None:
+        self._keys.clear()
+
+
+_recent_keys = RecentKeyFilter()
+
+# JSON canónico -> reading_meta.id (solo entradas ya confirmadas en la BD)
+META_CACHE_SIZE = 10_000
+_meta_ids: "OrderedDict[str, int]" = OrderedDict()
+
+
+def _local_naive(dt: datetime) -> datetime:
+    # sensor_readings.ts es hora local sin zona: se convierte lo que traiga offset
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo is not None else dt
+
+
+def normalize_ts(ts: Any) -> str:
+    """
+    ts de una lectura -> ISO local sin zona, el formato de sensor_readings.ts.
+    Solo None, NaN o vacío cuentan como "sin ts" (ahora). Acepta ISO con o sin
+    offset ('Z' incluido), datetime y epoch en segundos o milisegundos.
+    Lanza ValueError si no se puede interpretar.
+    """
+    if ts is None or ts != ts or (isinstance(ts, str) and not ts.strip()):  # ts != ts: NaN / NaT
+        return datetime.now().isoformat(timespec="seconds")
+    if isinstance(ts, datetime):
+        dt = ts
+    elif isinstance(ts, numbers.Real) and not isinstance(ts, bool):
+        epoch = float(ts)
+        dt = datetime.fromtimestamp(epoch / 1000.0 if abs(epoch) >= 1e11 else epoch)
+    elif isinstance(ts, str):
+        s = ts.strip()
+        try:
+            dt = datetime.fromisoformat(s[:-1] + "+00:00" if s[-1] in "Zz" else s)
+        except ValueError:
+            # epoch como texto ("1767261900")
+            return normalize_ts(float(s))
+    else:
+        raise ValueError(f"ts no reconocido: {ts!r}")
+    return _format_ts(_local_naive(dt))
+
+
+def _format_ts(dt: datetime) -> str:
+    return dt.isoformat(timespec="microseconds" if dt.microsecond else "seconds")
+
+
+def canonical_meta(meta: Dict[str, Any]) -> str:
+    return json.dumps(meta, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _intern_meta(conn: sqlite3.Connection, canonical: str) -> int:
+    """
+    Retorna el id de reading_meta para el JSON canónico, insertándolo si no existe.
+    """
+    h = hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+    conn.execute("INSERT OR IGNORE INTO reading_meta(hash, meta_json) VALUES (?,?)", (h, canonical))
+    return int(conn.execute("SELECT id FROM reading_meta WHERE hash = ?", (h,)).fetchone()[0])
+
+
+def _cache_meta_ids(new_ids: Dict[str, int]) -> None:
+    for canonical, meta_id in new_ids.items():
+        _meta_ids[canonical] = meta_id
+        _meta_ids.move_to_end(canonical)
+    while len(_meta_ids) > META_CACHE_SIZE:
+        _meta_ids.popitem(last=False)
+
+
+def clear_ingest_caches() -> None:
+    """Vacía los caches en memoria (al cambiar de BD en el mismo proceso)."""
+    _recent_keys.clear()
+    _meta_ids.clear()
+
+
+def save_readings(conn: sqlite3.Connection, site_id: int, source_id: int,
+                  readings: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """
+    readings: lista dict con metric, value y opcional ts (ver normalize_ts)
+    Upsert por (site_id, source_id, metric, ts): reintentos no duplican filas
+    y un valor corregido reemplaza al anterior.
+    Los errores de la BD se cuentan como fallidas; cualquier otra excepción se
+    relanza después del rollback.
+    """
+    ok = 0
+    bad = 0
+    rows: Dict[Tuple[int, Optional[int], str, str], Tuple[float, Optional[str]]] = {}
+    for r in readings:
+        try:
+            metric = str(r["metric"])
+            value = float(r["value"])
+            if value != value:
+                raise ValueError("valor NaN")
+            ts = normalize_ts(r.get("ts"))
+            meta = {k: v for k, v in r.items() if k not in ("metric", "value", "ts")}
+            canonical = canonical_meta(meta) if meta else None
+            ok += 1
+            key = (site_id, source_id, metric, ts)
+            if _recent_keys.seen(key, value):
+                continue
+            rows[key] = (value, canonical)
+        except Exception:
+            bad += 1
+
+    if not rows:
+        return ok, bad
+    new_meta_ids: Dict[str, int] = {}
+    try:
+        params = []
+        for k, (v, canonical) in rows.items():
+            meta_id = None
+            if canonical is not None:
+                meta_id = _meta_ids.get(canonical) or new_meta_ids.get(canonical)
+                if meta_id is None:
+                    meta_id = new_meta_ids[canonical] = _intern_meta(conn, canonical)
+            params.append((k[0], k[1], k[3], k[2], v, meta_id))
+        conn.executemany(UPSERT_READING_SQL, params)
+        update_derived_metrics(conn, site_id, [(k[2], k[3]) for k in rows])
+        conn.commit()
+    except Exception as e:
+        # Cualquier error, no solo sqlite3.Error: sin rollback la conexión
+        # queda con la transacción abierta y la BD bloqueada para los demás
+        conn.rollback()
+        if not isinstance(e, sqlite3.Error):
+            raise
+        return ok - len(rows), bad + len(rows)
+    _cache_meta_ids(new_meta_ids)
+    for k, (v, _) in rows.items():
+        _recent_keys.add(k, v)
+    return ok, bad
+
+
+# -----------------------------
+# Métricas derivadas (incrementales)
+# -----------------------------
+def _derived_source_id(conn: sqlite3.Connection, site_id: int) -> int:
+    row = conn.execute("""
+        SELECT id FROM sensor_sources WHERE site_id = ? AND protocol = 'DERIVED' ORDER BY id LIMIT 1
+    """, (site_id,)).fetchone()
+    if row:
+        return int(row[0])
+    cur = conn.execute("""
+        INSERT INTO sensor_sources(site_id, name, protocol, config_json, enabled)
+        VALUES (?,?,?,?,1)
+    """, (site_id, "Métricas derivadas", "DERIVED", json.dumps({"note": "Calculadas al ingresar lecturas."})))
+    return int(cur.lastrowid)
+
+
+def _parse_ts(ts: str) -> Optional[datetime]:
+    """ts guardado -> datetime local sin zona; None si no se puede interpretar."""
+    try:
+        return _local_naive(datetime.fromisoformat(ts))
+    except (TypeError, ValueError):
+        return None
+
+
+def update_derived_metrics(conn: sqlite3.Connection, site_id: int, written: Iterable[Tuple[str, str]]) -> int:
+    """
+    Recalcula las métricas derivadas del tipo de sitio en los ts de las lecturas
+    recién escritas (metric, ts) y en los ts ya existentes dentro de
+    (t, t + max_skew_s], cuyo valor as-of pudo cambiar con una entrada tardía.
+    Cada entrada se alinea as-of: último valor con ts <= t y antigüedad
+    <= max_skew_s. Compara datetimes, no texto. No hace commit (va en la
+    transacción del llamador).
+    """
+    written = list(written)
+    if not written:
+        return 0
+    row = conn.execute("SELECT type FROM sites WHERE id = ?", (site_id,)).fetchone()
+    formulas = formulas_for(row[0] if row else None)
+    out = []
+    for f in formulas:
+        written_dt = sorted({dt for dt in (_parse_ts(ts) for metric, ts in written if metric in f.inputs) if dt})
+        if not written_dt:
+            continue
+        skew = timedelta(seconds=f.max_skew_s)
+        since = (written_dt[0] - skew).isoformat()
+        until = (written_dt[-1] + skew).isoformat()
+        series: Dict[str, Tuple[List[datetime], List[float]]] = {}
+        for metric in f.inputs:
+            pts = sorted((dt, v) for dt, v in ((_parse_ts(p[0]), p[1]) for p in conn.execute("""
+                SELECT ts, value FROM sensor_readings
+                WHERE site_id = ? AND metric = ? AND ts >= ? AND ts <= ?
+            """, (site_id, metric, since, until))) if dt)
+            series[metric] = ([p[0] for p in pts], [p[1] for p in pts])
+        existing = {_parse_ts(r[0]) for r in conn.execute("""
+            SELECT ts FROM sensor_readings
+            WHERE site_id = ? AND metric = ? AND ts > ? AND ts <= ?
+        """, (site_id, f.name, written_dt[0].isoformat(), until))}
+        existing.discard(None)
+        candidates = sorted(existing.union(*(series[m][0] for m in f.inputs)))
+
+        # Puntos posteriores afectados: (t, t + max_skew_s] de cada ts escrito
+        trigger = set(written_dt)
+        for t in written_dt:
+            trigger.update(candidates[bisect_right(candidates, t):bisect_right(candidates, t + skew)])
+
+        for t in sorted(trigger):
+            args = []
+            for metric in f.inputs:
+                dts, values = series[metric]
+                i = bisect_right(dts, t) - 1
+                if i < 0 or t - dts[i] > skew:
+                    break
+                args.append(values[i])
+            else:
+                value = f.fn(*args)
+                if value is not None:
+                    out.append((_format_ts(t), f.name, round(float(value), 3)))
+
+    if out:
+        source_id = _derived_source_id(conn, site_id)
+        conn.executemany(UPSERT_READING_SQL, [(site_id, source_id, ts, m, v, None) for ts, m, v in out])
+    return len(out)
@@ -0,0 +1,29 @@
+"""
+Job único: elimina lecturas duplicadas de una BD existente y crea la llave
+única (site_id, source_id, metric, ts) usada por la ingesta idempotente.
+
+Uso:
+  python dedupe_readings.py [ruta.sqlite]
+"""
+import sqlite3
+import sys
+import time
+
+from db import DB_PATH, dedupe_readings, ensure_readings_key
+
+
+def main() -> None:
+    path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    conn = sqlite3.connect(path)
+    t0 = time.perf_counter()
+    before = conn.execute("SELECT COUNT(*) FROM sensor_readings").fetchone()[0]
+    removed = dedupe_readings(conn)
+    ensure_readings_key(conn)
+    conn.execute("VACUUM")
+    conn.close()
+    print(f"{path}: {before} lecturas, {removed} duplicadas eliminadas "
+          f"({time.perf_counter() - t0:.1f} s)")
+
+
+if __name__ == "__main__":
+    main()
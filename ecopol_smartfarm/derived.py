@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# -----------------------------
+# Métricas derivadas por tipo de sitio
+# -----------------------------
+@dataclass(frozen=True)
+class DerivedMetric:
+    name: str
+    inputs: Tuple[str, ...]
+    fn: Callable[..., Optional[float]]
+    max_skew_s: int = 15 * 60  # antigüedad máxima de una entrada para el alineamiento as-of
+    label: str = ""
+
+
+def thi(temp_c: float, hum_pct: float) -> float:
+    # Índice temperatura-humedad (NRC 1971), usado en aves y cerdos
+    return 0.8 * temp_c + (hum_pct / 100.0) * (temp_c - 14.4) + 46.4
+
+
+def nh3_co2_ratio(nh3_ppm: float, co2_ppm: float) -> Optional[float]:
+    if co2_ppm <= 0:
+        return None
+    return 1000.0 * nh3_ppm / co2_ppm
+
+
+def vent_demand(co2_ppm: float, nh3_ppm: float) -> float:
+    # % respecto de los límites de bienestar: CO2 3000 ppm, NH3 20 ppm
+    return max(0.0, min(100.0, 100.0 * max(co2_ppm / 3000.0, nh3_ppm / 20.0)))
+
+
+THI = DerivedMetric("thi", ("temp_c", "hum_pct"), thi, label="Índice temp.-humedad (THI)")
+NH3_CO2 = DerivedMetric("nh3_co2_ratio", ("nh3_ppm", "co2_ppm"), nh3_co2_ratio, label="NH3/CO2 (‰)")
+VENT = DerivedMetric("vent_demand_pct", ("co2_ppm", "nh3_ppm"), vent_demand, label="Demanda de ventilación (%)")
+
+DERIVED_BY_SITE_TYPE: Dict[str, List[DerivedMetric]] = {
+    "Avícola": [THI, NH3_CO2, VENT],
+    "Porcina": [THI, NH3_CO2, VENT],
+    "Mixta": [THI, NH3_CO2, VENT],
+}
+
+
+def formulas_for(site_type: Optional[str]) -> List[DerivedMetric]:
+    return DERIVED_BY_SITE_TYPE.get(site_type or "", [])
+
+
+def derived_names(site_type: Optional[str]) -> List[str]:
+    return [f.name for f in formulas_for(site_type)]
@@ -0,0 +1,308 @@
+"""
+Buffer local de lecturas delante del escritor SQLite.
+
+Archivo de anillo mapeado en memoria con registros binarios de tamaño fijo y
+número de secuencia. Los colectores hacen append a velocidad de memoria; el
+drenador reenvía los pendientes a sensor_readings en bloque cuando la BD
+acepta escrituras (lock de importación/retención, disco lleno, etc.). El
+drenador usa una conexión con busy timeout corto (DRAIN_BUSY_TIMEOUT_S): con
+la BD bloqueada se rinde enseguida en vez de esperar los 5 s de sqlite.
+
+Garantías:
+  - El archivo se preasigna al crearlo: un disco lleno no impide el append.
+  - Un registro cuenta como escrito cuando append() retorna; sobrevive a la
+    caída del proceso. append_readings() hace flush (msync) al final de cada
+    lote, así que el lote sobrevive también a una caída del SO o corte de energía.
+  - Los metadatos (JSON canónico) van a un diccionario al lado del anillo
+    (<archivo>.meta, una línea por meta_ref); el registro guarda solo el
+    meta_ref. Se sincroniza antes que el anillo y se vacía al drenar todo.
+  - Al abrir se recupera escaneando los slots (CRC + secuencia). El drenado
+    avanza la marca committed_seq después del commit en la BD; si se cae entre
+    ambos, el reenvío es un upsert por (site_id, source_id, metric, ts) y no
+    duplica filas ni borra metadatos ya guardados.
+  - Un solo proceso escritor por archivo.
+"""
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import REPLAY_READING_SQL, _intern_meta, canonical_meta, normalize_ts, update_derived_metrics
+
+MAGIC = b"ECOBUF2\0"  # v2: registro con meta_ref
+# magic, capacidad, tamaño registro, committed_seq
+HEADER = struct.Struct("<8sQQQ")
+HEADER_SIZE = 64
+COMMITTED_OFFSET = 24
+# seq, site_id, source_id (-1 = NULL), ts, metric, value, meta_ref (0 = sin meta), crc32
+RECORD = struct.Struct("<QIi32s24sdII")
+RECORD_SIZE = 88  # = RECORD.size; el meta_ref ocupa los 4 bytes que antes eran relleno
+META_SUFFIX = ".meta"
+
+BUFFER_PATH = "data/edge_buffer.ring"
+DRAIN_BUSY_TIMEOUT_S = 0.1
+DEFAULT_CAPACITY = 262_144  # ~23 MB
+
+
+class BufferFull(Exception):
+    pass
+
+
+class EdgeBuffer:
+    def __init__(self, path: str = BUFFER_PATH, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        # Registros descartados al drenar (rechazados por la BD o inválidos)
+        self.rejected = 0
+        self.last_rejection: Optional[str] = None
+        if not os.path.exists(path):
+            self._create(path, capacity)
+        self._fh = open(path, "r+b")
+        self._mm = mmap.mmap(self._fh.fileno(), 0)
+        magic, self.capacity, record_size, self.committed_seq = HEADER.unpack_from(self._mm, 0)
+        if magic == b"ECOBUF1\0":
+            raise ValueError(f"{path}: buffer de formato anterior (v1); drénelo con la versión previa")
+        if magic != MAGIC or record_size != RECORD_SIZE:
+            raise ValueError(f"{path}: no es un buffer de lecturas válido")
+        self.next_seq = self._recover()
+        # meta_ref -> JSON canónico (meta_ref = posición + 1)
+        self._metas: List[str] = []
+        self._meta_refs: Dict[str, int] = {}
+        self._meta_dirty = False
+        self._meta_fh = self._open_meta(path + META_SUFFIX)
+
+    @staticmethod
+    def _create(path: str, capacity: int) -> None:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, capacity, RECORD_SIZE, 0).ljust(HEADER_SIZE, b"\0"))
+            fh.truncate(HEADER_SIZE + capacity * RECORD_SIZE)
+            # Preasignación real de bloques (no un archivo disperso)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fh.fileno(), 0, HEADER_SIZE + capacity * RECORD_SIZE)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+
+    def _open_meta(self, path: str):
+        fh = open(path, "a+b")
+        fh.seek(0)
+        good = 0
+        for line in fh:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("línea incompleta")
+                canonical = json.loads(line)
+            except ValueError:
+                break  # línea a medias (caída): se corta ahí
+            self._metas.append(canonical)
+            self._meta_refs[canonical] = len(self._metas)
+            good += len(line)
+        fh.truncate(good)
+        return fh
+
+    def _meta_ref(self, meta: Optional[str]) -> int:
+        if meta is None:
+            return 0
+        ref = self._meta_refs.get(meta)
+        if ref is None:
+            # flush inmediato: el registro que lo referencia sobrevive a la caída del proceso
+            self._meta_fh.write(json.dumps(meta).encode("ascii") + b"\n")
+            self._meta_fh.flush()
+            self._metas.append(meta)
+            ref = self._meta_refs[meta] = len(self._metas)
+            self._meta_dirty = True
+        return ref
+
+    def _offset(self, seq: int) -> int:
+        return HEADER_SIZE + (seq % self.capacity) * RECORD_SIZE
+
+    def _read(self, seq: int) -> Optional[Tuple]:
+        off = self._offset(seq)
+        rec = RECORD.unpack_from(self._mm, off)
+        if rec[0] != seq or zlib.crc32(self._mm[off:off + RECORD.size - 4]) != rec[-1]:
+            return None
+        return rec
+
+    def _recover(self) -> int:
+        """Siguiente secuencia libre: la mayor secuencia válida en disco + 1."""
+        last = self.committed_seq
+        for slot in range(self.capacity):
+            off = HEADER_SIZE + slot * RECORD_SIZE
+            seq = struct.unpack_from("<Q", self._mm, off)[0]
+            if seq > last and seq % self.capacity == slot and self._read(seq) is not None:
+                last = seq
+        # Un registro roto (escritura a medias) corta la cola ahí
+        seq = self.committed_seq + 1
+        while seq <= last and self._read(seq) is not None:
+            seq += 1
+        return seq
+
+    def pending(self) -> int:
+        return self.next_seq - 1 - self.committed_seq
+
+    def append(self, site_id: int, source_id: Optional[int], metric: str, value: float, ts: Optional[str] = None,
+               meta: Optional[str] = None) -> int:
+        """meta: JSON canónico (canonical_meta) de los campos extra de la lectura."""
+        ts_b = (ts or datetime.now().isoformat(timespec="seconds")).encode("ascii")
+        metric_b = metric.encode("utf-8")
+        if len(ts_b) > 32 or len(metric_b) > 24:
+            raise ValueError("ts o metric demasiado largo para el registro")
+        with self._lock:
+            seq = self.next_seq
+            if seq - self.committed_seq > self.capacity:
+                raise BufferFull(f"{self.pending()} lecturas pendientes")
+            off = self._offset(seq)
+            body = RECORD.pack(seq, site_id, -1 if source_id is None else source_id, ts_b, metric_b, float(value),
+                               self._meta_ref(meta), 0)
+            crc = zlib.crc32(body[:-4])
+            self._mm[off:off + RECORD.size] = body[:-4] + struct.pack("<I", crc)
+            self.next_seq = seq + 1
+            return seq
+
+    def append_readings(self, site_id: int, source_id: Optional[int], readings: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """Mismo contrato que save_readings: (ok, bad). Un msync por lote."""
+        ok = 0
+        bad = 0
+        try:
+            for r in readings:
+                try:
+                    value = float(r["value"])
+                    if value != value:
+                        raise ValueError("valor NaN")
+                    meta = {k: v for k, v in r.items() if k not in ("metric", "value", "ts")}
+                    self.append(site_id, source_id, str(r["metric"]), value, normalize_ts(r.get("ts")),
+                                canonical_meta(meta) if meta else None)
+                    ok += 1
+                except BufferFull:
+                    raise
+                except Exception:
+                    bad += 1
+        finally:
+            # Lo ya escrito sobrevive también a una caída del SO / corte de energía;
+            # el diccionario de metadatos antes que los registros que lo usan
+            with self._lock:
+                if self._meta_dirty:
+                    os.fsync(self._meta_fh.fileno())
+                    self._meta_dirty = False
+            self._mm.flush()
+        return ok, bad
+
+    def drain(self, conn: sqlite3.Connection, batch: int = 5000) -> int:
+        """
+        Reenvía los pendientes a sensor_readings en bloques. Retorna cuántos se
+        procesaron; si la BD sigue ocupada (OperationalError) deja el resto para
+        el próximo intento. Los registros que fallan por sí mismos
+        (IntegrityError u otro error) se descartan y se cuentan en self.rejected.
+        Ante cualquier excepción se hace rollback: no queda la BD bloqueada.
+        """
+        done = 0
+        # Los append siguen durante la escritura en la BD; solo un drenador a la vez
+        with self._drain_lock:
+            while True:
+                with self._lock:
+                    start = self.committed_seq + 1
+                    end = min(self.next_seq, start + batch)
+                    if start >= end:
+                        break
+                    recs = [self._read(seq) for seq in range(start, end)]
+                rows = []
+                written: Dict[int, List[Tuple[str, str]]] = defaultdict(list)
+                for rec in recs:
+                    if rec is None:
+                        continue
+                    seq, site_id, source_id, ts_b, metric_b, value, meta_ref, _ = rec
+                    try:
+                        # Registros de versiones previas pueden traer ts sin normalizar
+                        ts = normalize_ts(ts_b.rstrip(b"\0").decode("ascii"))
+                    except ValueError as e:
+                        self.rejected += 1
+                        self.last_rejection = f"seq {seq}: {e}"
+                        continue
+                    metric = metric_b.rstrip(b"\0").decode("utf-8")
+                    meta = self._metas[meta_ref - 1] if 0 < meta_ref <= len(self._metas) else None
+                    rows.append((site_id, None if source_id < 0 else source_id, ts, metric, value, meta))
+                    written[site_id].append((metric, ts))
+                try:
+                    try:
+                        self._write(conn, rows, written)
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception:
+                        # Uno o más registros nunca entrarán (sitio/fuente borrados,
+                        # dato inválido): fila a fila, se descartan solo los que fallan
+                        conn.rollback()
+                        self._write_row_by_row(conn, rows)
+                except sqlite3.OperationalError:
+                    # BD bloqueada o disco lleno: queda pendiente para el próximo intento
+                    conn.rollback()
+                    break
+                except BaseException:
+                    conn.rollback()
+                    raise
+                with self._lock:
+                    self._set_committed(end - 1)
+                done += end - start
+            with self._lock:
+                if self.pending() == 0 and self._metas:
+                    # Ningún registro pendiente usa el diccionario: se vacía. La
+                    # marca committed_seq va a disco antes, para no reenviar
+                    # registros viejos con meta_ref reutilizados.
+                    self._mm.flush()
+                    self._meta_fh.truncate(0)
+                    self._metas.clear()
+                    self._meta_refs.clear()
+        return done
+
+    @staticmethod
+    def _params(conn: sqlite3.Connection, row: Tuple, meta_ids: Dict[str, int]) -> Tuple:
+        # row termina en el JSON canónico; en la BD va su reading_meta.id
+        meta = row[5]
+        if meta is not None and meta not in meta_ids:
+            meta_ids[meta] = _intern_meta(conn, meta)
+        return row[:5] + (meta_ids[meta] if meta is not None else None,)
+
+    def _write(self, conn: sqlite3.Connection, rows: List[Tuple], written: Dict[int, List[Tuple[str, str]]]) -> None:
+        meta_ids: Dict[str, int] = {}
+        conn.executemany(REPLAY_READING_SQL, [self._params(conn, row, meta_ids) for row in rows])
+        for site_id, keys in written.items():
+            update_derived_metrics(conn, site_id, keys)
+        conn.commit()
+
+    def _write_row_by_row(self, conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+        # Un savepoint por fila: lectura y derivadas entran o se descartan juntas
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        for row in rows:
+            conn.execute("SAVEPOINT fila")
+            try:
+                conn.execute(REPLAY_READING_SQL, self._params(conn, row, {}))
+                update_derived_metrics(conn, row[0], [(row[3], row[2])])
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                conn.execute("ROLLBACK TO fila")
+                self.rejected += 1
+                self.last_rejection = f"{row[:4]}: {type(e).__name__}: {e}"
+            conn.execute("RELEASE fila")
+        conn.commit()
+
+    def _set_committed(self, seq: int) -> None:
+        struct.pack_into("<Q", self._mm, COMMITTED_OFFSET, seq)
+        self.committed_seq = seq
+
+    def flush(self) -> None:
+        self._mm.flush()
+
+    def close(self) -> None:
+        self._mm.flush()
+        self._mm.close()
+        self._fh.close()
+        self._meta_fh.close()
@@ -0,0 +1,393 @@
+"""
+Harness de carga de ingesta, 100% offline.
+
+Simula N sitios (galpones) con señales temp_c / hum_pct / co2_ppm / nh3_ppm /
+water_lpm y las hace pasar por los caminos reales de entrada:
+  - HTTP: stub local consumido con fetch_http_readings
+  - MQTT: broker en proceso (stand-in) + mqtt_payload_to_reading
+  - Modbus: simulador TCP de pymodbus leído con modbus_read_example
+Mide lecturas/s, latencia emisión -> visible en get_latest_metrics, crecimiento
+de la BD y latencia de consultas del dashboard mientras se escribe. Los fetch
+fallidos (HTTP/Modbus) y payloads MQTT inválidos se cuentan por protocolo.
+
+Uso:
+  python load_harness.py [--sites 60] [--ticks 30] [--db /tmp/carga.sqlite] [--modbus-port 15020]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import queue
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from connectors import (
+    MODBUS_REGISTER_MAP,
+    fetch_http_readings,
+    modbus_read_example,
+    mqtt_payload_to_reading,
+    registers_to_readings,
+)
+from db import TREND_METRICS, clear_ingest_caches, db_init, get_latest_metrics, get_multi_history, save_readings
+from derived import derived_names
+
+try:
+    from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+    from pymodbus.server import ServerStop, StartAsyncTcpServer
+except Exception:
+    StartAsyncTcpServer = None
+
+PROTOCOLS = ["HTTP", "MQTT", "MODBUS"]
+SITE_TYPES = ["Avícola", "Porcina", "Mixta"]
+MODBUS_PORT = 15020
+
+
+# -----------------------------
+# Señales simuladas
+# -----------------------------
+class BarnSignal:
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.base_temp = self.rng.uniform(19.0, 24.0)
+        self.nh3 = self.rng.uniform(5.0, 12.0)
+
+    def sample(self, t: datetime) -> Dict[str, float]:
+        day = math.sin(2 * math.pi * (t.hour + t.minute / 60.0 - 9) / 24)
+        temp = self.base_temp + 3.5 * day + self.rng.gauss(0, 0.2)
+        hum = max(30.0, min(95.0, 75.0 - 2.0 * (temp - self.base_temp) + self.rng.gauss(0, 1.0)))
+        # con calor se ventila más: baja CO2
+        co2 = max(450.0, 1800.0 - 250.0 * day + self.rng.gauss(0, 60))
+        self.nh3 = max(0.5, min(40.0, self.nh3 + self.rng.gauss(0, 0.3)))
+        water = max(0.0, 4.0 + 3.0 * max(day, 0) + self.rng.gauss(0, 0.3))
+        return {"temp_c": temp, "hum_pct": hum, "co2_ppm": co2, "nh3_ppm": self.nh3, "water_lpm": water}
+
+
+# -----------------------------
+# Stand-ins de entrada
+# -----------------------------
+class HttpStub:
+    """GET /sites/<id> entrega y vacía el buffer del gateway simulado."""
+
+    def __init__(self):
+        self.pending: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    site_id = int(self.path.rstrip("/").split("/")[-1])
+                except ValueError:
+                    self.send_error(404)
+                    return
+                with stub.lock:
+                    body = json.dumps(stub.pending.pop(site_id, [])).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/sites"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def push(self, site_id: int, readings: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self.pending[site_id].extend(readings)
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+class LocalBroker:
+    """Broker MQTT mínimo en proceso: publish encola (topic, payload)."""
+
+    def __init__(self):
+        self.q: "queue.Queue[Tuple[str, bytes]]" = queue.Queue()
+
+    def publish(self, topic: str, payload: bytes) -> None:
+        self.q.put((topic, payload))
+
+    def drain(self) -> List[Tuple[str, bytes]]:
+        out = []
+        while True:
+            try:
+                out.append(self.q.get_nowait())
+            except queue.Empty:
+                return out
+
+
+class ModbusSim:
+    """Simulador Modbus TCP (pymodbus); 5 holding registers por sitio."""
+
+    def __init__(self, n_slots: int, port: int = MODBUS_PORT):
+        self.port = port
+        # Puerto ocupado: un connect tendría éxito contra otro proceso
+        with socket.socket() as probe:
+            try:
+                probe.bind(("127.0.0.1", port))
+            except OSError as e:
+                raise RuntimeError(f"Puerto Modbus {port} ocupado ({e}); use --modbus-port") from None
+        self.slave = ModbusSlaveContext(hr=ModbusSequentialDataBlock(0, [0] * (n_slots * len(MODBUS_REGISTER_MAP) + 1)))
+        context = ModbusServerContext(slaves=self.slave, single=True)
+        self.thread = threading.Thread(
+            target=lambda: asyncio.run(StartAsyncTcpServer(context=context, address=("127.0.0.1", port))),
+            daemon=True,
+        )
+        self.thread.start()
+        self._wait_listening(timeout_s=5.0)
+
+    def _wait_listening(self, timeout_s: float) -> None:
+        deadline = time.perf_counter() + timeout_s
+        while True:
+            if not self.thread.is_alive():
+                raise RuntimeError(f"El simulador Modbus terminó sin escuchar en el puerto {self.port}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f"El simulador Modbus no escucha en el puerto {self.port}") from None
+                time.sleep(0.05)
+
+    def set_site(self, slot: int, values: Dict[str, float]) -> None:
+        regs = [max(0, min(65535, int(round(values[m] * scale)))) for m, scale in MODBUS_REGISTER_MAP]
+        self.slave.setValues(3, slot * len(regs), regs)
+
+    def close(self) -> None:
+        ServerStop()
+
+
+# -----------------------------
+# Medición de visibilidad / dashboard
+# -----------------------------
+class Watcher(threading.Thread):
+    """
+    Con su propia conexión espera que cada muestra (site_id, ts, t_emit) sea
+    visible en get_latest_metrics y cronometra las consultas del dashboard
+    (la misma grilla de Tendencias que arma app.py).
+    """
+
+    def __init__(self, db_path: str, site_types: Dict[int, str]):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.site_types = site_types
+        self.samples: "queue.Queue[Optional[Tuple[int, str, float]]]" = queue.Queue()
+        self.latency_s: List[float] = []
+        self.latest_q_s: List[float] = []
+        self.history_q_s: List[float] = []
+        self.timeouts = 0
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        while True:
+            item = self.samples.get()
+            if item is None:
+                break
+            site_id, ts, t_emit = item
+            deadline = time.perf_counter() + 10
+            while True:
+                t0 = time.perf_counter()
+                latest = get_latest_metrics(conn, site_id)
+                self.latest_q_s.append(time.perf_counter() - t0)
+                if not latest.empty and latest["ts"].max() >= ts:
+                    self.latency_s.append(time.perf_counter() - t_emit)
+                    break
+                if time.perf_counter() > deadline:
+                    self.timeouts += 1
+                    break
+                time.sleep(0.005)
+            t0 = time.perf_counter()
+            metrics = TREND_METRICS + derived_names(self.site_types.get(site_id))
+            get_multi_history(conn, site_id, metrics, 24, "15min", "ffill")
+            self.history_q_s.append(time.perf_counter() - t0)
+        conn.close()
+
+
+# -----------------------------
+# Harness
+# -----------------------------
+def setup_sites(conn: sqlite3.Connection, n: int) -> List[Tuple[int, int, str]]:
+    """Crea n sitios con una fuente cada uno. Retorna (site_id, source_id, protocolo)."""
+    cur = conn.cursor()
+    cur.execute("INSERT INTO clients(name, notes) VALUES (?,?)", ("Carga Simulada", "load_harness"))
+    client_id = cur.lastrowid
+    out = []
+    for i in range(n):
+        protocol = PROTOCOLS[i % len(PROTOCOLS)]
+        cur.execute("INSERT INTO sites(client_id, name, location, type) VALUES (?,?,?,?)",
+                    (client_id, f"Galpón {i + 1:04d}", "Simulado", SITE_TYPES[i % len(SITE_TYPES)]))
+        site_id = cur.lastrowid
+        cur.execute("""
+            INSERT INTO sensor_sources(site_id, name, protocol, config_json, enabled)
+            VALUES (?,?,?,?,1)
+        """, (site_id, f"{protocol} simulado", protocol, json.dumps({"harness": True})))
+        out.append((site_id, cur.lastrowid, protocol))
+    conn.commit()
+    return out
+
+
+def pct(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def db_bytes(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-journal", path + "-wal") if os.path.exists(p))
+
+
+def run(db_path: str, n_sites: int, ticks: int, tick_s: int, samples_per_tick: int,
+        modbus_port: int = MODBUS_PORT) -> Dict[str, Any]:
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    db_init(conn)
+    clear_ingest_caches()
+    sites = setup_sites(conn, n_sites)
+
+    if StartAsyncTcpServer is None:
+        print("pymodbus no está instalado: los sitios MODBUS se envían por MQTT.")
+        sites = [(s, src, "MQTT" if p == "MODBUS" else p) for s, src, p in sites]
+    modbus_sites = [s for s in sites if s[2] == "MODBUS"]
+
+    http = HttpStub()
+    broker = LocalBroker()
+    modbus = ModbusSim(len(modbus_sites), modbus_port) if modbus_sites else None
+    modbus_slot = {site_id: i for i, (site_id, _, _) in enumerate(modbus_sites)}
+    signals = {site_id: BarnSignal(site_id) for site_id, _, _ in sites}
+    source_of = {site_id: source_id for site_id, source_id, _ in sites}
+
+    watcher = Watcher(db_path, {int(r[0]): r[1] for r in conn.execute("SELECT id, type FROM sites")})
+    watcher.start()
+    size_before = db_bytes(db_path)
+    saved = bad = 0
+    by_protocol: Dict[str, int] = defaultdict(int)
+    # Lecturas o lotes que no llegaron a save_readings (fetch fallido, payload inválido)
+    fetch_failed: Dict[str, int] = defaultdict(int)
+    start_ts = datetime.now().replace(microsecond=0)
+    rng = random.Random(0)
+
+    t_start = time.perf_counter()
+    for tick in range(ticks):
+        ts_dt = start_ts + timedelta(seconds=tick * tick_s)
+        ts = ts_dt.isoformat(timespec="seconds")
+
+        # Emisión
+        t_emit = time.perf_counter()
+        for site_id, _, protocol in sites:
+            values = signals[site_id].sample(ts_dt)
+            if protocol == "HTTP":
+                http.push(site_id, [{"metric": m, "value": round(v, 2), "ts": ts} for m, v in values.items()])
+            elif protocol == "MQTT":
+                for m, v in values.items():
+                    payload = {"metric": m, "value": round(v, 2), "ts": ts, "site": f"Galpón {site_id}"}
+                    broker.publish(f"ecopol/smartfarm/site{site_id}", json.dumps(payload).encode("utf-8"))
+            else:
+                modbus.set_site(modbus_slot[site_id], values)
+        for site_id, _, _ in rng.sample(sites, min(samples_per_tick, len(sites))):
+            watcher.samples.put((site_id, ts, t_emit))
+
+        # Colección por los caminos reales
+        batches: List[Tuple[int, str, List[Dict[str, Any]]]] = []
+        for site_id, _, protocol in sites:
+            if protocol == "HTTP":
+                ok, _, data = fetch_http_readings(f"{http.url}/{site_id}", "", 5)
+                if ok:
+                    batches.append((site_id, protocol, data))
+                else:
+                    fetch_failed[protocol] += 1
+            elif protocol == "MODBUS":
+                ok, _, regs = modbus_read_example("127.0.0.1", modbus.port, 1,
+                                                  modbus_slot[site_id] * len(MODBUS_REGISTER_MAP),
+                                                  len(MODBUS_REGISTER_MAP))
+                if ok:
+                    batches.append((site_id, protocol, registers_to_readings(regs, ts)))
+                else:
+                    fetch_failed[protocol] += 1
+        per_site: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        for topic, payload in broker.drain():
+            reading = mqtt_payload_to_reading(payload)
+            if reading is None:
+                fetch_failed["MQTT"] += 1
+            else:
+                per_site[int(topic.rsplit("site", 1)[1])].append(reading)
+        batches += [(site_id, "MQTT", readings) for site_id, readings in per_site.items()]
+
+        for site_id, protocol, readings in batches:
+            ok, nbad = save_readings(conn, site_id, source_of[site_id], readings)
+            saved += ok
+            bad += nbad
+            by_protocol[protocol] += ok
+    elapsed = time.perf_counter() - t_start
+
+    watcher.samples.put(None)
+    watcher.join()
+    http.close()
+    if modbus:
+        modbus.close()
+    conn.close()
+
+    size_after = db_bytes(db_path)
+    return {
+        "sites": n_sites,
+        "ticks": ticks,
+        "readings_saved": saved,
+        "readings_failed": bad,
+        "by_protocol": dict(by_protocol),
+        "fetch_failed": {p: fetch_failed[p] for p in sorted({p for _, _, p in sites})},
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(saved / elapsed, 1) if elapsed else 0.0,
+        "e2e_latency_ms": {
+            "p50": round(1000 * pct(watcher.latency_s, 0.50), 1),
+            "p95": round(1000 * pct(watcher.latency_s, 0.95), 1),
+            "p99": round(1000 * pct(watcher.latency_s, 0.99), 1),
+            "samples": len(watcher.latency_s),
+            "timeouts": watcher.timeouts,
+        },
+        "dashboard_ms": {
+            "latest_p50": round(1000 * pct(watcher.latest_q_s, 0.50), 2),
+            "latest_p95": round(1000 * pct(watcher.latest_q_s, 0.95), 2),
+            "history_p50": round(1000 * pct(watcher.history_q_s, 0.50), 2),
+            "history_p95": round(1000 * pct(watcher.history_q_s, 0.95), 2),
+        },
+        "db_growth_bytes": size_after - size_before,
+        "bytes_per_reading": round((size_after - size_before) / saved, 1) if saved else None,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Harness de carga de ingesta (offline).")
+    ap.add_argument("--sites", type=int, default=60)
+    ap.add_argument("--ticks", type=int, default=30, help="Rondas de emisión de todos los sitios.")
+    ap.add_argument("--tick-seconds", type=int, default=60, help="Paso del reloj simulado.")
+    ap.add_argument("--samples", type=int, default=3, help="Muestras de latencia por ronda.")
+    ap.add_argument("--modbus-port", type=int, default=MODBUS_PORT, help="Puerto del simulador Modbus.")
+    ap.add_argument("--db", default=None, help="BD destino (por defecto una temporal nueva).")
+    ap.add_argument("--json", default=None, help="Guarda el resultado en este archivo.")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, "carga.sqlite")
+        result = run(db_path, args.sites, args.ticks, args.tick_seconds, args.samples, args.modbus_port)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()